@@ -1,15 +1,24 @@
 import logging
 import os
-import json
-from bs4 import BeautifulSoup
-from bs4.builder import ParserRejectedMarkup
-import re
+import signal
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from io import BytesIO
+from lxml import etree
+from lxml.cssselect import CSSSelector
+import lxml.html
+import html
 from pymongo import MongoClient
-from pymongo.errors import DuplicateKeyError, DocumentTooLarge
+from pymongo.errors import BulkWriteError, DocumentTooLarge
 import hashlib
+import pickle
 from datetime import datetime
+from pybloom_live import ScalableBloomFilter
 import psutil
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 # Configuration parameters
 SPIDER_API_KEY = os.environ.get("SPIDER_API_KEY")
@@ -21,15 +30,69 @@ COLLECTION_NAME = 'documents'
 SCHOOL_DATA_COLLECTION = 'school_data'
 RETRY_LIMIT = 3 # This is the Spider retry. Frankly, if it fails once it usually fails 3 times. 
 MAX_DOC_SIZE = 1024 * 1024 # 1MB. For me this is probably way over what's truly useful.
+BLOOM_FILTER_PATH = 'seen_documents.bloom' # Local dedupe filter, persisted between runs so restarts don't lose it.
+INSERT_BATCH_SIZE = 500 # One insert_many round trip per batch instead of one insert_one per page. Also bounds how much we buffer in memory.
+MAX_INFLIGHT_CLEANS = 4 # Pages queued in the cleaning pool at once. Raw HTML is big; the t2.nano can't hold a whole crawl's worth in flight.
 
 client = MongoClient(MONGO_URI)
 db = client[DB_NAME]
 documents_collection = db[COLLECTION_NAME]
 school_data_collection = db[SCHOOL_DATA_COLLECTION]
+# Without this the dedupe lookups turn into collection scans as the data grows. The unique
+# constraint also makes the index the real dupe gate; the pre-checks are just to save the write.
+documents_collection.create_index([('Base_URL', 1), ('content_hash', 1)], unique=True)
+# The work queue uses a single status field: pending -> processing -> done (or error). The loader
+# that fills school_data must set status to 'pending'. A positive equality match on an indexed field
+# is the only shape Mongo can serve without scanning; the old processed/processing/error negation
+# query walked the whole collection on every claim. The partial index only has to hold the
+# still-pending slice, which keeps it tiny.
+school_data_collection.create_index([('status', 1)], partialFilterExpression={'status': 'pending'})
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+interrupted = False # Flipped by Ctrl-C so the current crawl can flush what it has and requeue cleanly instead of dying mid-insert.
+
+def _handle_interrupt(signum, frame):
+    global interrupted
+    interrupted = True
+    logger.info("Interrupt received; finishing the current crawl then stopping.")
+
+# Bloom filter of (Base_URL, content_hash) pairs already inserted. The common case is "not a dupe",
+# and this answers that in memory instead of with a Mongo round trip per page.
+try:
+    with open(BLOOM_FILTER_PATH, 'rb') as f:
+        _seen_documents = pickle.load(f)
+except (FileNotFoundError, pickle.UnpicklingError, EOFError):
+    _seen_documents = ScalableBloomFilter(initial_capacity=100_000, error_rate=1e-4)
+
+def save_seen_documents():
+    with open(BLOOM_FILTER_PATH, 'wb') as f:
+        pickle.dump(_seen_documents, f)
+
+_pending_documents = [] # documents buffered for the next insert_many
+
+# HTML cleaning is the CPU-heavy step and the GIL caps it at one core. Worker processes are
+# only spawned on first use, so this costs nothing on boxes where the pool never gets work.
+_cleaning_pool = ProcessPoolExecutor(max_workers=max(1, (os.cpu_count() or 1) - 1))
+
+# One session for all Spider calls. Reusing the pooled HTTPS connection saves a full TLS
+# handshake per school, which adds up fast on the t2.nano. Transient gateway errors retry
+# here with backoff instead of burning a retry_count in Mongo.
+_session = requests.Session()
+_session.headers.update({
+    'Authorization': SPIDER_API_KEY,
+    'Content-Type': 'application/json',
+    'Accept-Encoding': 'gzip',
+})
+_session.mount('https://', HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=10,
+    # allowed_methods must include POST explicitly; urllib3's default set doesn't retry
+    # POSTs, which would make the status_forcelist a no-op for the crawl calls.
+    max_retries=Retry(total=RETRY_LIMIT, backoff_factor=0.5, status_forcelist=[502, 503, 504], allowed_methods=frozenset({'POST'})),
+))
+
 crawler_params = {
     'limit': 500, # This limits spider to 500 pages on a website. Some school websites are much larger. If a website returns all 500 I'll look to see if I think the pages returned are represntative or if I need to get more pages.
     'proxy_enabled': True,
@@ -40,9 +103,26 @@ crawler_params = {
 }
 crawl_results = None
 
+TAGS_TO_REMOVE = frozenset(['script', 'style', 'nav', 'footer', 'header', 'aside', 'form'])
+CLASSES_OR_IDS_TO_REMOVE = frozenset(['menu', 'sidebar', 'ad-section', 'navbar', 'modal', 'footer', 'masthead', 'comment', 'widget'])
+
+STREAMING_THRESHOLD = 512 * 1024 # pages bigger than this skip the full parse and go through the bounded-memory streaming path instead
+
+# Compiled once; matching everything to strip in a single C-level traversal beats walking
+# the tree from Python, so this is the path normal-sized pages take.
+_UNWANTED_SELECTOR = CSSSelector(', '.join(
+    sorted(TAGS_TO_REMOVE)
+    + ['.' + name for name in sorted(CLASSES_OR_IDS_TO_REMOVE)]
+    + ['#' + name for name in sorted(CLASSES_OR_IDS_TO_REMOVE)]
+))
 def hash_content(content): # This is to weed out duplicates as many sites have a huge number of dupes. don't include the URL in the hash.
-    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+    # Takes bytes or str. Passing bytes in one shot lets OpenSSL's SHA-NI path do the work
+    # without an extra encode of what can be a large page.
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    return hashlib.sha256(content).hexdigest()
 
+@lru_cache(maxsize=100_000) # pure function, and the helpers re-normalize the same URL several times per page
 def normalize_base_url(url): # I'm pulling from a list of URLs formatted in different ways. I want a standard way to store them when referencing the content so I normailze them.
     if not url.startswith(('http://', 'https://')):
         url = 'https://' + url
@@ -50,79 +130,140 @@ def normalize_base_url(url): # I'm pulling from a list of URLs formatted in diff
 
 def document_exists(base_url, content_hash): # This is the actual dupe check.
     normalized_url = normalize_base_url(base_url)
-    return documents_collection.count_documents({'Base_URL': normalized_url, 'content_hash': content_hash}) > 0
+    # find_one with a projection is a straight index lookup; count_documents was doing more work to answer the same yes/no question.
+    return documents_collection.find_one({'Base_URL': normalized_url, 'content_hash': content_hash}, projection={'_id': 1}) is not None
 
-def truncate_content(content, max_size): # for my purposes data beyond the size I need is fine to truncate. I had been chunking it but found the additional data did not add to accuracy of RAG results. YMMV depending on your use case.
-    content_bytes = content.encode('utf-8')
+def truncate_content(content, max_size, content_bytes=None): # for my purposes data beyond the size I need is fine to truncate. I had been chunking it but found the additional data did not add to accuracy of RAG results. YMMV depending on your use case.
+    if content_bytes is None:
+        # UTF-8 is at most 4 bytes per codepoint, so anything this short can't exceed
+        # max_size and we skip encoding a copy of the whole page.
+        if len(content) <= max_size // 4:
+            return content
+        content_bytes = content.encode('utf-8')
     if len(content_bytes) > max_size:
-        truncated_bytes = content_bytes[:max_size]
-        return truncated_bytes.decode('utf-8', errors='ignore')
+        return memoryview(content_bytes)[:max_size].tobytes().decode('utf-8', errors='ignore')
     return content
 
 def insert_document(doc_id, base_url, unitid, website, url, content): # Save the results.
-    content_hash = hash_content(content)
-    truncated_content = truncate_content(content, MAX_DOC_SIZE)
-    if not document_exists(base_url, content_hash) or UPDATE_EXISTING:
-        try:
-            documents_collection.insert_one({
-                'doc_id': doc_id,
-                'Base_URL': base_url,  #because the data I'm pulling this list from isn't normlized, I keep the origional url to reference back. If you can avoid having to do something like this, you should.
-                'UNITID': unitid, # A Unique ID per normalized URL
-                'website': website, #this is the normalized URL
-                'url': url, #This is the actual page being saved. Probably not the best name as it's confusing with wesbite and Base_URL.
-                'date_scraped': datetime.now().isoformat(),
-                'content': truncated_content, #this is the cleaned and truncated content of the web page.
-                'content_hash': content_hash
-            })
-        except DuplicateKeyError:
-            logger.warning(f"Document with doc_id {doc_id} already exists. Skipping insertion.")
-        except DocumentTooLarge:
-            logger.error(f"Document with doc_id {doc_id} is too large even after truncation. Skipping insertion.")
-    else:
-        logger.info(f"Skipping document insertion for URL {base_url} as it already exists with the same content.")
+    content_bytes = content.encode('utf-8') # encode once, shared by the hash and the truncation check
+    content_hash = hash_content(content_bytes)
+    truncated_content = truncate_content(content, MAX_DOC_SIZE, content_bytes)
+    seen_key = base_url + ':' + content_hash
+    if seen_key in _seen_documents and not UPDATE_EXISTING:
+        # The filter can (rarely) false-positive, so confirm with Mongo before skipping.
+        if document_exists(base_url, content_hash):
+            logger.info(f"Skipping document insertion for URL {base_url} as it already exists with the same content.")
+            return
+    _pending_documents.append({
+        'doc_id': doc_id,
+        'Base_URL': base_url,  #because the data I'm pulling this list from isn't normlized, I keep the origional url to reference back. If you can avoid having to do something like this, you should.
+        'UNITID': unitid, # A Unique ID per normalized URL
+        'website': website, #this is the normalized URL
+        'url': url, #This is the actual page being saved. Probably not the best name as it's confusing with wesbite and Base_URL.
+        'date_scraped': datetime.now().isoformat(),
+        'content': truncated_content, #this is the cleaned and truncated content of the web page.
+        'content_hash': content_hash
+    })
+    if len(_pending_documents) >= INSERT_BATCH_SIZE:
+        flush_pending_documents()
+
+def flush_pending_documents(): # One round trip for the whole batch. insert_one per page was the biggest network cost in the write path.
+    if not _pending_documents:
+        return
+    try:
+        documents_collection.insert_many(_pending_documents, ordered=False)
+    except BulkWriteError as e:
+        # ordered=False means the rest of the batch still went in; dupes are expected and fine.
+        logger.warning(f"{len(e.details.get('writeErrors', []))} documents in batch were rejected (most likely duplicates). Continuing.")
+    except DocumentTooLarge:
+        logger.error("A document in the batch is too large even after truncation. Dropping the batch.")
+    for doc in _pending_documents:
+        _seen_documents.add(doc['Base_URL'] + ':' + doc['content_hash'])
+    _pending_documents.clear()
+
+_processed_cache = set() # base URLs already confirmed processed during this run, so we only ask Mongo once per school
+_seen_raw_html = set() # hashes of raw HTML bodies seen this run. Lots of sites serve the same template on every page; no point cleaning it twice.
 
 def baseurl_already_processed(base_url): # just a double check. If this school already has pages saved, skip it.
     normalized_url = normalize_base_url(base_url)
-    document = documents_collection.find_one({'Base_URL': normalized_url})
-    if document:
-        school_data_collection.update_one({'WEBADDR': base_url}, {'$set': {'processed': True, 'processing': False}})
-        return True
-    return False
+    if normalized_url not in _processed_cache:
+        document = documents_collection.find_one({'Base_URL': normalized_url}, projection={'_id': 1})
+        if document is None:
+            return False
+        _processed_cache.add(normalized_url)
+    # This row was just claimed and set to 'processing', so it has to be marked done even on
+    # a cache hit or it would sit in 'processing' forever, invisible to the queue.
+    school_data_collection.update_one({'WEBADDR': base_url}, {'$set': {'status': 'done'}})
+    return True
 
 def mark_as_error(base_url):
-    school_data_collection.update_one({'WEBADDR': base_url}, {'$inc': {'retry_count': 1}})
-    school = school_data_collection.find_one({'WEBADDR': base_url})
+    school = school_data_collection.find_one_and_update({'WEBADDR': base_url}, {'$inc': {'retry_count': 1}}, return_document=True)
     if school and school.get('retry_count', 0) >= RETRY_LIMIT:
-        school_data_collection.update_one({'WEBADDR': base_url}, {'$set': {'error': True, 'processing': False}})
+        school_data_collection.update_one({'WEBADDR': base_url}, {'$set': {'status': 'error'}})
+    else:
+        school_data_collection.update_one({'WEBADDR': base_url}, {'$set': {'status': 'pending'}}) # requeue for another try
 
-def clean_html_content(html_content): #98% of these pages is styling and stuff other than the data a RAG needs. 
-    try:
-        soup = BeautifulSoup(html_content, 'html.parser')
-    except ParserRejectedMarkup:
-        soup = BeautifulSoup(html_content, 'lxml')
+def _is_unwanted(element): # The boilerplate a RAG doesn't need: scripts, nav, sidebars and so on.
+    if not isinstance(element.tag, str): # comments and processing instructions
+        return False
+    if element.tag in TAGS_TO_REMOVE:
+        return True
+    classes = element.get('class')
+    if classes and CLASSES_OR_IDS_TO_REMOVE.intersection(classes.split()):
+        return True
+    return element.get('id') in CLASSES_OR_IDS_TO_REMOVE
 
-    tags_to_remove = ['script', 'style', 'nav', 'footer', 'header', 'aside', 'form']
-    classes_or_ids_to_remove = ['menu', 'sidebar', 'ad-section', 'navbar', 'modal', 'footer', 'masthead', 'comment', 'widget']
-    
-    for tag in tags_to_remove:
-        for element in soup.find_all(tag):
-            element.decompose()
-    
-    for identifier in classes_or_ids_to_remove:
-        for element in soup.find_all(class_=identifier):
-            element.decompose()
-        for element in soup.find_all(id=identifier):
-            element.decompose()
-    
-    text = soup.get_text(separator=' ')
-    text = re.sub(r'[\r\n]+', '\n', text)
-    text = re.sub(r'\s{2,}', ' ', text)
-    text = re.sub(r'&[a-z]+;', '', text)
-    return text
+def extract_text_streaming(html_content): # Streaming parse so we never hold a full DOM for a multi-MB page. On the t2.nano that was a real problem.
+    if isinstance(html_content, str):
+        html_content = html_content.encode('utf-8')
+    parts = []
+    skip_depth = 0 # how many levels deep we are inside an unwanted element
+    for event, element in etree.iterparse(BytesIO(html_content), events=('start', 'end'), html=True, recover=True):
+        if event == 'start':
+            if skip_depth:
+                skip_depth += 1
+            elif _is_unwanted(element):
+                skip_depth = 1
+            elif element.text:
+                # Text has to be collected here: end events fire children-first, so waiting
+                # for them emits a parent's text after all of its children's.
+                parts.append(element.text)
+        else:
+            if skip_depth:
+                skip_depth -= 1
+            if skip_depth == 0 and element.tail:
+                parts.append(element.tail)
+            element.clear() # free each element as soon as it's processed
+            parent = element.getparent()
+            if parent is not None:
+                while element.getprevious() is not None:
+                    del parent[0]
+    return ' '.join(parts)
+
+def clean_html_content(html_content): #98% of these pages is styling and stuff other than the data a RAG needs.
+    if len(html_content) > STREAMING_THRESHOLD:
+        text = extract_text_streaming(html_content)
+    else:
+        try:
+            try:
+                root = lxml.html.fromstring(html_content)
+            except ValueError:
+                # fromstring refuses str input that carries an XML encoding declaration, which
+                # plenty of older XHTML school sites still have. The same markup as bytes is fine.
+                root = lxml.html.fromstring(html_content.encode('utf-8'))
+        except etree.ParserError: # empty or hopeless markup; nothing worth keeping
+            return ''
+        for element in _UNWANTED_SELECTOR(root):
+            element.drop_tree() # unlike remove(), this keeps the element's tail text
+        # Space-joining itertext keeps words from fusing across element boundaries,
+        # matching what the streaming path (and the old soup.get_text) produce.
+        text = ' '.join(root.itertext())
+    # html.unescape resolves named entities properly instead of the old regex that just deleted them.
+    # The split/join dance collapses whitespace in one C-level pass per line, no regex engine needed.
+    text = html.unescape(text)
+    return '\n'.join(' '.join(line.split()) for line in text.splitlines() if line.strip())
 
 def process_data(data):
-    global interrupted
-    
     base_url = data.get('WEBADDR')
     unitid = data.get('UNITID')
 
@@ -133,34 +274,21 @@ def process_data(data):
     logger.info(f"Processing: {base_url}")
     normalized_base_url = normalize_base_url(base_url)
 
-    if baseurl_already_processed(normalized_base_url):
+    # Pass the raw WEBADDR: the helper normalizes for the documents lookup itself, but its
+    # school_data status update has to filter on the un-normalized address or it matches nothing.
+    if baseurl_already_processed(base_url):
         logger.info(f"Skipping processing for {normalized_base_url} as it has already been processed.")
         return
 
-    headers = {
-        'Authorization': SPIDER_API_KEY,
-        'Content-Type': 'application/json',
-    }
-
     try:
-        response = requests.post(
+        response = _session.post(
             'https://api.spider.cloud/crawl',
-            headers=headers,
-            json=crawler_params | {"url": normalized_base_url},
-            stream=True
+            json=crawler_params | {"url": normalized_base_url}
         )
         response.raise_for_status()
-        buffer = b""
-        crawl_results = None
-        for chunk in response.iter_content(chunk_size=8192):
-            if chunk:
-                buffer += chunk
-                try:
-                    data = json.loads(buffer.decode('utf-8'))
-                    crawl_results = data.get('items', [])
-                    buffer = b""
-                except json.JSONDecodeError:
-                    continue
+        # The whole body gets buffered either way since the API returns one JSON document,
+        # so let urllib3 read it and parse exactly once. No point pretending to stream.
+        crawl_results = response.json().get('items', [])
 
     except Exception as e:
         logger.error(f"Failed to fetch data for {normalized_base_url}, skipping: {e}")
@@ -172,32 +300,56 @@ def process_data(data):
         mark_as_error(base_url)
         return
 
+    # Farm the CPU-heavy cleaning out across cores, keeping only a small window of pages
+    # in flight at once so a 500-page crawl doesn't sit pickled in the pool's queue.
+    cleaning_jobs = deque()
+
+    def drain_one_cleaning_job():
+        specific_page_url, job = cleaning_jobs.popleft()
+        cleaned_text = job.result()
+        doc_id = hash_content(cleaned_text.encode('utf-8') + specific_page_url.encode('utf-8'))
+        insert_document(doc_id, normalized_base_url, unitid, normalized_base_url, specific_page_url, cleaned_text)
+        logger.info(normalized_base_url)
+
     for item in crawl_results:
         if interrupted:
-            school_data_collection.update_one({'WEBADDR': base_url}, {'$set': {'processing': False}})
-            return
+            break
 
         html_content = item['content']
         if html_content is None:
             logger.warning(f"No content retrieved for {item['url']}")
             continue
 
-        specific_page_url = item['url']
-        cleaned_text = clean_html_content(html_content)
-        
-        doc_id = hash_content(cleaned_text + specific_page_url)
-        try:
-            insert_document(doc_id, normalized_base_url, unitid, normalized_base_url, specific_page_url, cleaned_text)
-        except DocumentTooLarge:
-            logger.error(f"Document for URL {specific_page_url} is too large even after truncation. Skipping insertion.")
-        logger.info(normalized_base_url)
+        # Hashing the raw bytes is orders of magnitude cheaper than parsing them, so dupes
+        # get thrown out before the cleaning step ever sees them.
+        raw_hash = hashlib.sha256(html_content.encode('utf-8') if isinstance(html_content, str) else html_content).digest()
+        if raw_hash in _seen_raw_html:
+            logger.info(f"Skipping {item['url']} as identical raw HTML was already processed this run.")
+            continue
+        _seen_raw_html.add(raw_hash)
+
+        if len(cleaning_jobs) >= MAX_INFLIGHT_CLEANS:
+            drain_one_cleaning_job()
+        cleaning_jobs.append((item['url'], _cleaning_pool.submit(clean_html_content, html_content)))
+
+    while cleaning_jobs and not interrupted:
+        drain_one_cleaning_job()
+
+    if interrupted:
+        for _, job in cleaning_jobs:
+            job.cancel()
+        flush_pending_documents() # don't lose pages we already cleaned
+        school_data_collection.update_one({'WEBADDR': base_url}, {'$set': {'status': 'pending'}})
+        return
 
-    school_data_collection.update_one({'WEBADDR': base_url}, {'$set': {'processed': True, 'processing': False}})
+    flush_pending_documents()
+    school_data_collection.update_one({'WEBADDR': base_url}, {'$set': {'status': 'done'}})
 
 def fetch_and_process_next_url():
     data = school_data_collection.find_one_and_update(
-        {'processed': {'$ne': True}, 'processing': {'$ne': True}, 'error': {'$exists': False}},
-        {'$set': {'processing': True}},
+        {'status': 'pending'},
+        {'$set': {'status': 'processing'}},
+        projection={'_id': 1, 'WEBADDR': 1, 'UNITID': 1},
         return_document=True
     )
     
@@ -210,11 +362,13 @@ def fetch_and_process_next_url():
 def scrape_and_store():
     processed_count = 0
 
-    while processed_count < URL_PROCESS_LIMIT:
+    while processed_count < URL_PROCESS_LIMIT and not interrupted:
         fetch_and_process_next_url()
         processed_count += 1
 
+    save_seen_documents()
     logger.info("Data scraping and storage process completed successfully.")
 
 if __name__ == "__main__":
+    signal.signal(signal.SIGINT, _handle_interrupt)
     scrape_and_store()
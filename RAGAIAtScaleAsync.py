@@ -0,0 +1,186 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import aiohttp
+import psutil
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import BulkWriteError
+
+# The cleaning/hashing helpers are pure functions, so the two scripts share them.
+from RAGAIAtScale import (
+    SPIDER_API_KEY,
+    MONGO_URI,
+    DB_NAME,
+    COLLECTION_NAME,
+    SCHOOL_DATA_COLLECTION,
+    URL_PROCESS_LIMIT,
+    RETRY_LIMIT,
+    MAX_DOC_SIZE,
+    UPDATE_EXISTING,
+    crawler_params,
+    clean_html_content,
+    hash_content,
+    normalize_base_url,
+    truncate_content,
+)
+
+MAX_WORKERS = 10 # The crawler is I/O bound waiting on Spider, so this many concurrent crawls keeps the pipe full without blowing out memory on the t2.nano.
+
+client = AsyncIOMotorClient(MONGO_URI)
+db = client[DB_NAME]
+documents_collection = db[COLLECTION_NAME]
+school_data_collection = db[SCHOOL_DATA_COLLECTION]
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+async def document_exists(base_url, content_hash):
+    normalized_url = normalize_base_url(base_url)
+    document = await documents_collection.find_one({'Base_URL': normalized_url, 'content_hash': content_hash}, projection={'_id': 1})
+    return document is not None
+
+_processed_cache = set() # base URLs already confirmed processed during this run, so we only ask Mongo once per school
+_seen_raw_html = set() # hashes of raw HTML bodies seen this run. Lots of sites serve the same template on every page; no point cleaning it twice.
+
+# Cleaning is CPU bound and would otherwise block the event loop, so it runs in worker processes.
+_cleaning_pool = ProcessPoolExecutor(max_workers=max(1, (os.cpu_count() or 1) - 1))
+
+async def baseurl_already_processed(base_url): # just a double check. If this school already has pages saved, skip it.
+    normalized_url = normalize_base_url(base_url)
+    if normalized_url not in _processed_cache:
+        document = await documents_collection.find_one({'Base_URL': normalized_url}, projection={'_id': 1})
+        if document is None:
+            return False
+        _processed_cache.add(normalized_url)
+    # This row was just claimed and set to 'processing', so it has to be marked done even on
+    # a cache hit or it would sit in 'processing' forever, invisible to the queue.
+    await school_data_collection.update_one({'WEBADDR': base_url}, {'$set': {'status': 'done'}})
+    return True
+
+async def mark_as_error(base_url):
+    school = await school_data_collection.find_one_and_update({'WEBADDR': base_url}, {'$inc': {'retry_count': 1}}, return_document=True)
+    if school and school.get('retry_count', 0) >= RETRY_LIMIT:
+        await school_data_collection.update_one({'WEBADDR': base_url}, {'$set': {'status': 'error'}})
+    else:
+        await school_data_collection.update_one({'WEBADDR': base_url}, {'$set': {'status': 'pending'}}) # requeue for another try
+
+async def process_data(session, data):
+    base_url = data.get('WEBADDR')
+    unitid = data.get('UNITID')
+
+    if not base_url or not unitid:
+        logger.warning("Missing required data fields. Skipping this entry.")
+        return
+
+    logger.info(f"Processing: {base_url}")
+    normalized_base_url = normalize_base_url(base_url)
+
+    # Pass the raw WEBADDR: the helper normalizes for the documents lookup itself, but its
+    # school_data status update has to filter on the un-normalized address or it matches nothing.
+    if await baseurl_already_processed(base_url):
+        logger.info(f"Skipping processing for {normalized_base_url} as it has already been processed.")
+        return
+
+    try:
+        async with session.post('https://api.spider.cloud/crawl', json=crawler_params | {"url": normalized_base_url}) as response:
+            response.raise_for_status()
+            buffer = bytearray()
+            async for chunk in response.content.iter_chunked(8192):
+                buffer.extend(chunk)
+        crawl_results = json.loads(bytes(buffer)).get('items', []) if buffer else None
+    except Exception as e:
+        logger.error(f"Failed to fetch data for {normalized_base_url}, skipping: {e}")
+        await mark_as_error(base_url)
+        return
+
+    if crawl_results is None:
+        logger.error(f"Failed to fetch data for {normalized_base_url}, skipping.")
+        await mark_as_error(base_url)
+        return
+
+    pending = []
+    for item in crawl_results:
+        html_content = item['content']
+        if html_content is None:
+            logger.warning(f"No content retrieved for {item['url']}")
+            continue
+
+        # Cheap raw-bytes dupe check before the expensive cleaning step.
+        raw_hash = hashlib.sha256(html_content.encode('utf-8') if isinstance(html_content, str) else html_content).digest()
+        if raw_hash in _seen_raw_html:
+            logger.info(f"Skipping {item['url']} as identical raw HTML was already processed this run.")
+            continue
+        _seen_raw_html.add(raw_hash)
+
+        specific_page_url = item['url']
+        cleaned_text = await asyncio.get_running_loop().run_in_executor(_cleaning_pool, clean_html_content, html_content)
+
+        content_bytes = cleaned_text.encode('utf-8')
+        content_hash = hash_content(content_bytes)
+        if await document_exists(normalized_base_url, content_hash) and not UPDATE_EXISTING:
+            logger.info(f"Skipping document insertion for URL {normalized_base_url} as it already exists with the same content.")
+            continue
+
+        pending.append({
+            'doc_id': hash_content(content_bytes + specific_page_url.encode('utf-8')),
+            'Base_URL': normalized_base_url,
+            'UNITID': unitid,
+            'website': normalized_base_url,
+            'url': specific_page_url,
+            'date_scraped': datetime.now().isoformat(),
+            'content': truncate_content(cleaned_text, MAX_DOC_SIZE, content_bytes),
+            'content_hash': content_hash
+        })
+        logger.info(normalized_base_url)
+
+    if pending:
+        try:
+            await documents_collection.insert_many(pending, ordered=False)
+        except BulkWriteError as e:
+            logger.warning(f"{len(e.details.get('writeErrors', []))} documents in batch were rejected (most likely duplicates). Continuing.")
+
+    await school_data_collection.update_one({'WEBADDR': base_url}, {'$set': {'status': 'done'}})
+
+async def worker(session, counter):
+    while counter['processed'] < URL_PROCESS_LIMIT:
+        counter['processed'] += 1
+        data = await school_data_collection.find_one_and_update(
+            {'status': 'pending'},
+            {'$set': {'status': 'processing'}},
+            projection={'_id': 1, 'WEBADDR': 1, 'UNITID': 1},
+            return_document=True
+        )
+
+        if data is None:
+            logger.info("No more unprocessed data available.")
+            return
+
+        await process_data(session, data)
+        # Keeping an eye on memory. The t2.nano does not leave much headroom, but sampling
+        # every URL was a syscall plus a log line per page; every 50th is plenty to spot a leak.
+        if counter['processed'] % 50 == 0:
+            logger.info(f"Memory usage: {psutil.Process(os.getpid()).memory_info().rss / (1024 * 1024):.1f} MB")
+
+async def scrape_and_store():
+    counter = {'processed': 0}
+    headers = {
+        'Authorization': SPIDER_API_KEY,
+        'Content-Type': 'application/json',
+    }
+    # Same compound unique index the sync script builds; dedupe lookups and the unique
+    # constraint both depend on it.
+    await documents_collection.create_index([('Base_URL', 1), ('content_hash', 1)], unique=True)
+    # Work-queue index; only the still-pending slice is indexed. See the sync script for the status scheme.
+    await school_data_collection.create_index([('status', 1)], partialFilterExpression={'status': 'pending'})
+    async with aiohttp.ClientSession(headers=headers) as session:
+        await asyncio.gather(*(worker(session, counter) for _ in range(MAX_WORKERS)))
+
+    logger.info("Data scraping and storage process completed successfully.")
+
+if __name__ == "__main__":
+    asyncio.run(scrape_and_store())